@@ -3,7 +3,7 @@
 Improved Streamlit app for polling Upstox option chain.
 
 Key improvements made:
- - Use requests.Session for connection pooling
+ - Use a persistent httpx.Client (HTTP/2 keep-alive, transport retries) for connection pooling
  - Safer, atomic writes for latest/history files
  - More defensive parsing of contract/chain responses
  - Clearer logging to Streamlit sidebar
@@ -13,16 +13,24 @@ Key improvements made:
 """
 
 import streamlit as st
-import requests
-import json
+import httpx
+import orjson
 import time
-from datetime import date
-from typing import Any, Dict, List, Optional
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from numba import njit
 import pandas as pd
+import pyarrow as pa
+import zstandard
 from dateutil import parser as date_parser
 from pathlib import Path
 import tempfile
 import os
+import sys
+import atexit
+import threading
 
 # --------------------------
 # Config - change paths if needed
@@ -35,15 +43,32 @@ DATA_DIR = BASE_DIR / "data"
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 ACCESS_TOKEN_FILE = DATA_DIR / "access_token.txt"   # local fallback (dev only)
-HISTORY_FILE      = DATA_DIR / "nifty_option_chain_history.jsonl"
+HISTORY_FILE      = DATA_DIR / "nifty_option_chain_history.jsonl.zst"
+HISTORY_ARROW     = DATA_DIR / "nifty_option_chain_history.arrow"
 LATEST_FILE       = DATA_DIR / "nifty_option_chain_latest.json"
+ZSTD_DICT_FILE    = DATA_DIR / "nifty_chain.zdict"     # trained from the first ZSTD_DICT_SAMPLES history records
+ZSTD_DICT_SAMPLES = 100
+ZSTD_DICT_SIZE    = 100_000
 BASE = "https://api.upstox.com"
+_HAS_O_TMPFILE = sys.platform.startswith("linux") and hasattr(os, "O_TMPFILE")
 DEFAULT_INSTRUMENT_KEY = "NSE_INDEX|Nifty 50"
 
 
 # --------------------------
 # Utility functions
 # --------------------------
+def utc_iso(now: float) -> str:
+    return datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+_local_ts_cache: List[Any] = [None, ""]
+
+def local_ts(now: float) -> str:
+    # log lines within the same second share one formatted string
+    sec = int(now)
+    if sec != _local_ts_cache[0]:
+        _local_ts_cache[:] = [sec, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec))]
+    return _local_ts_cache[1]
+
 def load_token(path: Path = ACCESS_TOKEN_FILE) -> Optional[str]:
     try:
         # Streamlit secrets override local file (useful when deployed)
@@ -57,59 +82,174 @@ def load_token(path: Path = ACCESS_TOKEN_FILE) -> Optional[str]:
     except FileNotFoundError:
         return None
 
-def get_contracts(session: requests.Session, token: str, instrument_key: str = DEFAULT_INSTRUMENT_KEY) -> Dict[str, Any]:
+# Known alternate spellings -> canonical key (the name the Upstox v2 payload uses / the preferred one).
+# Order matters: when several aliases of one key are present, the earlier entry wins.
+ALIASES = {
+    "expiry": "expiry_date", "expiryDate": "expiry_date",
+    "strike": "strike_price", "strikePrice": "strike_price",
+    "CE": "call_options", "call": "call_options",
+    "PE": "put_options", "put": "put_options",
+    "marketData": "market_data", "greeks": "option_greeks",
+    "last_price": "ltp", "lastTradedPrice": "ltp",
+    "best_bid": "bid", "best_ask": "ask",
+    "open_interest": "oi", "traded_volume": "volume",
+    "implied_volatility": "iv",
+    "last_updated": "updated_at", "timestamp": "updated_at",
+}
+_ALIASES_LOWEST_FIRST = tuple(reversed(ALIASES.items()))
+_ALIAS_KEYS = frozenset(ALIASES)
+
+def canonicalize(obj: Any) -> Any:
+    # rewrite aliased keys (recursively) to their canonical name. Merged lowest priority first, so a
+    # canonical key beats any alias and earlier aliases beat later ones; presence decides, so 0/"" survive.
+    # Containers without aliases are reused (children updated in place): pass freshly parsed JSON only.
+    if isinstance(obj, list):
+        for i, v in enumerate(obj):
+            if isinstance(v, (dict, list)):
+                obj[i] = canonicalize(v)
+        return obj
+    if not isinstance(obj, dict):
+        return obj
+    if _ALIAS_KEYS.isdisjoint(obj):
+        for k, v in obj.items():
+            if isinstance(v, (dict, list)):
+                obj[k] = canonicalize(v)
+        return obj
+    aliased = {canon: canonicalize(obj[alias]) for alias, canon in _ALIASES_LOWEST_FIRST if alias in obj}
+    return aliased | {k: canonicalize(v) for k, v in obj.items() if k not in ALIASES}
+
+def make_http_client(encoding_seen: Optional[Dict[str, str]] = None) -> httpx.Client:
+    # one HTTP/2 connection kept alive across polls; the transport retries failed connection attempts.
+    # Advertise brotli (decoded by httpx when the `brotli` package is installed) ahead of gzip.
+    hooks = {}
+    if encoding_seen is not None:
+        # remember the first Content-Encoding the server answers with (hooks may run on worker threads)
+        def note_encoding(resp: httpx.Response) -> None:
+            encoding_seen.setdefault("content-encoding", resp.headers.get("content-encoding", "identity"))
+        hooks["response"] = [note_encoding]
+    return httpx.Client(
+        transport=httpx.HTTPTransport(http2=True, retries=2),
+        timeout=15.0,
+        headers={"Accept": "application/json", "Accept-Encoding": "br, gzip, deflate"},
+        event_hooks=hooks,
+    )
+
+def get_contracts(client: httpx.Client, token: str, instrument_key: str = DEFAULT_INSTRUMENT_KEY) -> Dict[str, Any]:
     url = f"{BASE}/v2/option/contract"
-    headers = {"Accept": "application/json", "Authorization": f"Bearer {token}"}
-    resp = session.get(url, headers=headers, params={"instrument_key": instrument_key}, timeout=15)
+    headers = {"Authorization": f"Bearer {token}"}
+    resp = client.get(url, headers=headers, params={"instrument_key": instrument_key}, timeout=15)
     # don't raise here; return JSON or a dict explaining the error
     try:
-        payload = resp.json()
+        payload = canonicalize(orjson.loads(resp.content))
     except Exception:
         payload = {"error": f"Invalid JSON from contracts endpoint (status {resp.status_code})"}
-    if not resp.ok:
+    if not resp.is_success:
         payload.setdefault("error", f"HTTP {resp.status_code}")
     return payload
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_contracts_cached(_client: httpx.Client, token: str, instrument_key: str = DEFAULT_INSTRUMENT_KEY) -> Dict[str, Any]:
+    # expiries change at most daily; keyed on token + instrument (the client is not hashed).
+    # Errors are raised rather than returned so they are never cached.
+    payload = get_contracts(_client, token, instrument_key=instrument_key)
+    if "error" in payload:
+        raise RuntimeError(payload["error"])
+    return payload
+
+def _fast_parse(dstr: Any) -> Optional[date]:
+    # Upstox sends ISO dates, so try the C parser on the date part first; dateutil only for odd formats
+    try:
+        return date.fromisoformat(dstr[:10])
+    except (TypeError, ValueError):
+        pass
+    try:
+        return date_parser.parse(dstr).date()
+    except Exception:
+        return None
+
 def choose_nearest_expiry(contract_json: Dict[str, Any]) -> Optional[str]:
     data = contract_json.get("data", []) if isinstance(contract_json, dict) else []
-    dates: List[tuple] = []
-    for item in data:
-        dstr = None
-        if isinstance(item, dict):
-            dstr = item.get("expiry_date") or item.get("expiry") or item.get("expiryDate") or item.get("date")
-        elif isinstance(item, str):
-            dstr = item
-        if not dstr:
-            continue
-        try:
-            dt = date_parser.parse(dstr).date()
-            if dt >= date.today():
-                dates.append((dt, dt.isoformat()))
-        except Exception:
-            continue
+    candidates = (
+        item.get("expiry_date", item.get("date")) if isinstance(item, dict) else item
+        for item in data
+        if isinstance(item, (dict, str))
+    )
+    today = date.today()
+    dates = [dt for dstr in candidates if dstr and (dt := _fast_parse(dstr)) and dt >= today]
     if not dates:
         return None
-    dates.sort()
-    return dates[0][1]
+    return min(dates).isoformat()
 
-def fetch_option_chain(session: requests.Session, token: str, expiry: str, instrument_key: str = DEFAULT_INSTRUMENT_KEY) -> Dict[str, Any]:
+def fetch_option_chain(client: httpx.Client, token: str, expiry: str, instrument_key: str = DEFAULT_INSTRUMENT_KEY) -> Dict[str, Any]:
     url = f"{BASE}/v2/option/chain"
-    headers = {"Accept": "application/json", "Authorization": f"Bearer {token}"}
+    headers = {"Authorization": f"Bearer {token}"}
     params = {"instrument_key": instrument_key, "expiry_date": expiry}
-    resp = session.get(url, headers=headers, params=params, timeout=30)
+    resp = client.get(url, headers=headers, params=params, timeout=30)
     try:
-        payload = resp.json()
+        payload = canonicalize(orjson.loads(resp.content))
     except Exception:
         payload = {"error": f"Invalid JSON from chain endpoint (status {resp.status_code})"}
-    if not resp.ok:
+    if not resp.is_success:
         payload.setdefault("error", f"HTTP {resp.status_code}")
     return payload
 
-def atomic_write_json(path: Path, data: Any, indent: Optional[int] = None) -> None:
+def fetch_contracts_and_chain(pool: ThreadPoolExecutor, client: httpx.Client, token: str, guess_expiry: Optional[str], instrument_key: str = DEFAULT_INSTRUMENT_KEY) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    # contracts run on the pool while the chain for the guessed expiry is fetched here, so latency is max(a, b)
+    contracts_fut = pool.submit(get_contracts_cached, client, token, instrument_key)
+    chain = fetch_option_chain(client, token, guess_expiry, instrument_key=instrument_key) if guess_expiry else None
+    return contracts_fut.result(), chain
+
+def _poll_once(client: httpx.Client, token: str, expiry: str, instrument_key: str = DEFAULT_INSTRUMENT_KEY) -> Tuple[Dict[str, Any], pd.DataFrame]:
+    # runs on the worker pool: HTTP fetch, orjson decode and flatten, none of which touch Streamlit state
+    snapshot = fetch_option_chain(client, token, expiry, instrument_key=instrument_key)
+    return snapshot, option_chain_json_to_df(snapshot)
+
+def _atomic_write_bytes_tmpfile(path: Path, blob: bytes) -> bool:
+    # Linux: write into an unnamed O_TMPFILE inode and link it into place, so a crash mid-write leaves nothing behind.
+    # Returns False (target untouched) when the filesystem or sandbox doesn't support O_TMPFILE / linking via /proc.
+    try:
+        fd = os.open(str(path.parent), os.O_TMPFILE | os.O_WRONLY, 0o644)
+    except OSError:
+        return False
+    try:
+        view = memoryview(blob)
+        while view:
+            view = view[os.write(fd, view):]
+        fd_path = f"/proc/self/fd/{fd}"
+        if not path.exists():
+            # first write: link straight into place
+            try:
+                os.link(fd_path, str(path), follow_symlinks=True)
+                return True
+            except FileExistsError:
+                pass  # created concurrently; overwrite it below
+            except OSError:
+                return False
+        # linkat can't overwrite: publish under a private name, then rename over the target atomically
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            os.link(fd_path, str(tmp_path), follow_symlinks=True)
+        except OSError:
+            return False
+        try:
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return True
+    finally:
+        os.close(fd)
+
+def atomic_write_bytes(path: Path, blob: bytes) -> None:
+    global _HAS_O_TMPFILE
+    if _HAS_O_TMPFILE:
+        if _atomic_write_bytes_tmpfile(path, blob):
+            return
+        _HAS_O_TMPFILE = False  # not supported here; use mkstemp + replace from now on
     tmp_fd, tmp_path = tempfile.mkstemp(prefix=path.name, dir=str(path.parent))
     try:
-        with os.fdopen(tmp_fd, "w") as f:
-            json.dump(data, f, indent=indent)
+        with os.fdopen(tmp_fd, "wb") as f:
+            f.write(blob)
         os.replace(tmp_path, str(path))
     except Exception:
         try:
@@ -118,66 +258,312 @@ def atomic_write_json(path: Path, data: Any, indent: Optional[int] = None) -> No
             pass
         raise
 
-def append_jsonl(path: Path, obj: Any) -> None:
+def atomic_write_json(path: Path, data: Any, indent: Optional[int] = None) -> None:
+    atomic_write_bytes(path, orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0))
+
+def _load_zstd_dict() -> Optional[zstandard.ZstdCompressionDict]:
+    try:
+        return zstandard.ZstdCompressionDict(ZSTD_DICT_FILE.read_bytes())
+    except FileNotFoundError:
+        return None
+
+@st.cache_resource(show_spinner=False)
+def _history_handle(path: Path) -> Dict[str, Any]:
+    # opened once per path for the process lifetime (survives reruns); unbuffered so each frame is one write()
     path.parent.mkdir(parents=True, exist_ok=True)
-    line = json.dumps(obj, default=str)
-    with path.open("a") as f:
-        f.write(line + "\n")
+    fh = open(path, "ab", buffering=0)
+    atexit.register(fh.close)
+    zdict = _load_zstd_dict()
+    return {
+        "fh": fh,
+        "cctx": zstandard.ZstdCompressor(level=3, dict_data=zdict),
+        # until a dictionary exists, keep the first records around to train one
+        "samples": [] if zdict is None else None,
+        "lock": threading.Lock(),
+    }
+
+def _maybe_train_zstd_dict(state: Dict[str, Any], line: bytes) -> None:
+    samples = state["samples"]
+    samples.append(line)
+    if len(samples) < ZSTD_DICT_SAMPLES:
+        return
+    state["samples"] = None
+    # another history path may have trained the shared dictionary meanwhile; never replace it
+    zdict = _load_zstd_dict()
+    if zdict is None:
+        try:
+            zdict = zstandard.train_dictionary(ZSTD_DICT_SIZE, samples)
+        except zstandard.ZstdError:
+            return
+        atomic_write_bytes(ZSTD_DICT_FILE, zdict.as_bytes())
+    state["cctx"] = zstandard.ZstdCompressor(level=3, dict_data=zdict)
+
+def append_jsonl(path: Path, obj: Any) -> None:
+    # one zstd frame per record, so every line can be decompressed independently
+    line = orjson.dumps(obj, default=str, option=orjson.OPT_APPEND_NEWLINE)
+    state = _history_handle(path)
+    with state["lock"]:
+        state["fh"].write(state["cctx"].compress(line))
+        if state["samples"] is not None:
+            _maybe_train_zstd_dict(state, line)
+
+def read_history_jsonl(path: Path = HISTORY_FILE) -> List[Any]:
+    # frames written before the dictionary existed decode fine with it loaded
+    dctx = zstandard.ZstdDecompressor(dict_data=_load_zstd_dict())
+    with open(path, "rb") as fh, dctx.stream_reader(fh, read_across_frames=True) as reader:
+        return [orjson.loads(line) for line in reader.read().splitlines() if line]
 
 
 # Flatten function (tolerant to missing keys)
-def option_chain_json_to_df(json_obj: Dict[str, Any]) -> pd.DataFrame:
-    if isinstance(json_obj, dict) and "snapshot" in json_obj and isinstance(json_obj["snapshot"], dict):
-        json_obj = json_obj["snapshot"]
+# Per-side fields read straight from canonicalized payloads: (field, source), source indexes (market_data, option_greeks)
+_MD, _OG = 0, 1
+SIDE_SCHEMA = (
+    ("ltp", _MD), ("bid", _MD), ("ask", _MD), ("oi", _MD), ("volume", _MD),
+    ("iv", _OG), ("delta", _OG), ("gamma", _OG), ("theta", _OG), ("vega", _OG), ("pop", _OG),
+)
+SIDE_FIELDS = tuple(field for field, _ in SIDE_SCHEMA)
+# output column names precomputed once per side
+SIDE_COLUMNS = {
+    prefix: tuple((f"{prefix}_{field}", src, field) for field, src in SIDE_SCHEMA)
+    for prefix in ("call", "put")
+}
+CHAIN_COLUMNS = ("strike", "underlying", "timestamp") + tuple(
+    f"{prefix}_{field}" for prefix in ("call", "put") for field in SIDE_FIELDS
+)
+NUMERIC_COLUMNS = [c for c in CHAIN_COLUMNS if c not in ("underlying", "timestamp")]
+NUMERIC_COLUMN_SET = frozenset(NUMERIC_COLUMNS)
+# fixed column types, declared once and reused for every snapshot (no per-poll type inference)
+CHAIN_SCHEMA = pa.schema([(c, pa.float64() if c in NUMERIC_COLUMN_SET else pa.string()) for c in CHAIN_COLUMNS])
+
+
+@njit(cache=True)
+def compute_derived(call_ltp: np.ndarray, put_ltp: np.ndarray, call_oi: np.ndarray, put_oi: np.ndarray):
+    # per-strike derived columns in one compiled pass; NaN legs count as 0 in the straddle
+    n = call_ltp.size
+    straddle = np.empty(n)
+    pcr = np.empty(n)
+    for i in range(n):
+        c = call_ltp[i] if call_ltp[i] == call_ltp[i] else 0.0
+        p = put_ltp[i] if put_ltp[i] == put_ltp[i] else 0.0
+        straddle[i] = c + p
+        pcr[i] = put_oi[i] / call_oi[i] if call_oi[i] > 0 else np.nan
+    return straddle, pcr
+
+
+# compile (or load from the on-disk cache) up front so the first poll doesn't pay for it
+compute_derived(np.zeros(1), np.zeros(1), np.zeros(1), np.zeros(1))
+
+
+def _arrow_float(values: List[Any]) -> pa.Array:
+    try:
+        return pa.array(values, type=pa.float64())
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        # strings / odd values from the API: coerce like pd.to_numeric(errors="coerce")
+        return pa.array(pd.to_numeric(pd.Series(values, dtype=object), errors="coerce"), type=pa.float64(), from_pandas=True)
 
-    data = json_obj.get("data", []) if isinstance(json_obj, dict) else []
-    rows: List[Dict[str, Any]] = []
+def _arrow_str(values: List[Any]) -> pa.Array:
+    try:
+        return pa.array(values, type=pa.string())
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+def _chain_table(cols: Dict[str, List[Any]]) -> pa.Table:
+    try:
+        return pa.Table.from_pydict(cols, schema=CHAIN_SCHEMA)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        # some column carries values of the wrong JSON type: convert column by column with coercion
+        return pa.Table.from_arrays(
+            [_arrow_float(cols[c]) if c in NUMERIC_COLUMN_SET else _arrow_str(cols[c]) for c in CHAIN_COLUMNS],
+            schema=CHAIN_SCHEMA,
+        )
+
+
+def _flatten_generic(data: Any) -> Dict[str, List[Any]]:
+    # build column-wise (one list per output column) instead of a list of row dicts
+    cols: Dict[str, List[Any]] = {name: [] for name in CHAIN_COLUMNS}
 
     for item in data:
         if not isinstance(item, dict):
             continue
-        strike = item.get("strike_price") or item.get("strike") or item.get("strikePrice")
-        call = item.get("call_options", {}) or item.get("CE", {}) or item.get("call", {})
-        put = item.get("put_options", {}) or item.get("PE", {}) or item.get("put", {})
-
-        def extract_side(side_obj: dict, prefix: str) -> dict:
-            out = {}
+        cols["strike"].append(item.get("strike_price"))
+        cols["underlying"].append(item["underlying"] if "underlying" in item else item.get("instrument_key"))
+        cols["timestamp"].append(item.get("updated_at"))
+        for prefix, side_obj in (("call", item.get("call_options")), ("put", item.get("put_options"))):
             if not isinstance(side_obj, dict):
-                return out
-            md = side_obj.get("market_data", {}) or side_obj.get("marketData", {}) or {}
-            og = side_obj.get("option_greeks", {}) or side_obj.get("greeks", {}) or {}
-            out[f"{prefix}_ltp"] = md.get("ltp") or md.get("last_price") or md.get("lastTradedPrice")
-            out[f"{prefix}_bid"] = md.get("bid") or md.get("best_bid")
-            out[f"{prefix}_ask"] = md.get("ask") or md.get("best_ask")
-            out[f"{prefix}_oi"] = md.get("oi") or md.get("open_interest")
-            out[f"{prefix}_volume"] = md.get("volume") or md.get("traded_volume")
-            out[f"{prefix}_iv"] = og.get("iv") or og.get("implied_volatility")
-            out[f"{prefix}_delta"] = og.get("delta")
-            out[f"{prefix}_gamma"] = og.get("gamma")
-            out[f"{prefix}_theta"] = og.get("theta")
-            out[f"{prefix}_vega"] = og.get("vega")
-            out[f"{prefix}_pop"] = og.get("pop") or side_obj.get("pop")
-            return out
-
-        row = {
-            "strike": strike,
-            "underlying": item.get("underlying") or item.get("instrument_key"),
-            "timestamp": item.get("updated_at") or item.get("last_updated") or item.get("timestamp"),
-        }
-        row.update(extract_side(call, "call"))
-        row.update(extract_side(put, "put"))
-        rows.append(row)
-
-    df = pd.DataFrame(rows)
-    for col in df.columns:
-        if col in ("underlying", "timestamp"):
-            continue
-        df[col] = pd.to_numeric(df[col], errors="coerce")
-    if "call_ltp" in df.columns and "put_ltp" in df.columns:
-        df["straddle_price"] = df["call_ltp"].fillna(0) + df["put_ltp"].fillna(0)
-    if "strike" in df.columns:
-        df = df.sort_values("strike").reset_index(drop=True)
-    return df
+                side_obj = {}
+            srcs = (side_obj.get("market_data") or {}, side_obj.get("option_greeks") or {})
+            for col, src, key in SIDE_COLUMNS[prefix]:
+                cols[col].append(srcs[src].get(key))
+            if "pop" not in srcs[_OG]:
+                # some payloads carry pop on the side object rather than in the greeks
+                cols[f"{prefix}_pop"][-1] = side_obj.get("pop")
+    return cols
+
+
+_SIDE_KEYS = ("call_options", "put_options")
+_SRC_KEYS = ("market_data", "option_greeks")
+
+def _observed_paths(item: Dict[str, Any]) -> Optional[Tuple[Tuple[str, Tuple[str, ...]], ...]]:
+    # For each CHAIN_COLUMNS entry, how this payload layout reaches it: ("key", path) when the field is present,
+    # ("get", path) when only its parent dict is (optional field), ("underlying"/"pop", ...) for the two columns
+    # with a fallback source. None when a side or source dict is missing: a specialised flattener could only
+    # fill those columns with None, so the generic walker handles that snapshot.
+    def spec(path: Tuple[str, ...], container: Dict[str, Any]) -> Tuple[str, Tuple[str, ...]]:
+        return ("key" if path[-1] in container else "get", path)
+
+    specs = [spec(("strike_price",), item), ("underlying", ()), spec(("updated_at",), item)]
+    for side_key in _SIDE_KEYS:
+        side_obj = item.get(side_key)
+        if not isinstance(side_obj, dict):
+            return None
+        srcs = tuple(side_obj.get(k) for k in _SRC_KEYS)
+        if not all(isinstance(src, dict) for src in srcs):
+            return None
+        for field, src in SIDE_SCHEMA:
+            if field == "pop":
+                specs.append(("pop", (side_key, _SRC_KEYS[src])))
+            else:
+                specs.append(spec((side_key, _SRC_KEYS[src], field), srcs[src]))
+    return tuple(specs)
+
+@st.cache_resource(show_spinner=False)
+def _flattener_registry() -> Dict[Tuple[Tuple[str, Tuple[str, ...]], ...], Any]:
+    # compiled flatteners by layout; a plain dict so the per-snapshot lookup is one tuple hash, not a cache-key digest
+    return {}
+
+def _compile_flattener(specs: Tuple[Tuple[str, Tuple[str, ...]], ...]):
+    # Generate a flattener specialised to one observed key layout: straight subscripts (plain .get only for
+    # optional fields), no alias fallbacks. A snapshot that doesn't match raises KeyError/TypeError/AttributeError
+    # and the caller falls back to _flatten_generic.
+    prefixes: Dict[Tuple[str, ...], str] = {}
+    for kind, path in specs:
+        for depth in range(1, len(path) + (kind == "pop")):
+            prefixes.setdefault(path[:depth], f"p{len(prefixes)}")
+    src = ["def _flat(data):", "    cols = {c: [] for c in COLUMNS}"]
+    src += [f"    a{i} = cols[{col!r}].append" for i, col in enumerate(CHAIN_COLUMNS)]
+    src.append("    for item in data:")
+    for prefix, var in prefixes.items():
+        parent = prefixes.get(prefix[:-1], "item")
+        src.append(f"        {var} = {parent}[{prefix[-1]!r}]")
+    for i, (kind, path) in enumerate(specs):
+        if kind == "underlying":
+            expr = "item['underlying'] if 'underlying' in item else item.get('instrument_key')"
+        elif kind == "pop":
+            # same precedence as _flatten_generic: greeks pop, else the side object's own pop
+            greeks, side = prefixes[path], prefixes[path[:1]]
+            expr = f"{greeks}['pop'] if 'pop' in {greeks} else {side}.get('pop')"
+        else:
+            parent = prefixes.get(path[:-1], "item")
+            expr = f"{parent}[{path[-1]!r}]" if kind == "key" else f"{parent}.get({path[-1]!r})"
+        src.append(f"        a{i}({expr})")
+    src.append("    return cols")
+    ns: Dict[str, Any] = {"COLUMNS": CHAIN_COLUMNS}
+    exec(compile("\n".join(src), "<option-chain-flattener>", "exec"), ns)
+    return ns["_flat"]
+
+
+
+def option_chain_json_to_df(json_obj: Dict[str, Any]) -> pd.DataFrame:
+    if isinstance(json_obj, dict) and "snapshot" in json_obj and isinstance(json_obj["snapshot"], dict):
+        json_obj = json_obj["snapshot"]
+
+    data = json_obj.get("data", []) if isinstance(json_obj, dict) else []
+    cols = None
+    specs = _observed_paths(data[0]) if isinstance(data, list) and data and isinstance(data[0], dict) else None
+    if specs is not None:
+        registry = _flattener_registry()
+        flatten = registry.get(specs)
+        if flatten is None:
+            if len(registry) >= 8:
+                registry.clear()
+            flatten = registry[specs] = _compile_flattener(specs)
+        try:
+            cols = flatten(data)
+        except (KeyError, TypeError, AttributeError):
+            # schema drift inside this snapshot: use the generic walker
+            cols = None
+    if cols is None:
+        cols = _flatten_generic(data)
+
+    table = _chain_table(cols)
+    # nulls come out as NaN; astype copies so numba always sees writable float64 arrays
+    straddle, pcr = compute_derived(
+        *(table.column(c).to_numpy().astype(np.float64) for c in ("call_ltp", "put_ltp", "call_oi", "put_oi"))
+    )
+    table = table.append_column("straddle_price", pa.array(straddle)).append_column("pcr", pa.array(pcr, from_pandas=True))
+    order = np.argsort(table.column("strike").to_numpy(), kind="stable")
+    # Arrow-backed columns: st.dataframe and the Arrow history log use the buffers without re-encoding
+    return table.take(order).to_pandas(types_mapper=pd.ArrowDtype)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _read_latest_cached(path: str, mtime_ns: int, size: int) -> Tuple[bytes, Any]:
+    blob = Path(path).read_bytes()
+    return blob, orjson.loads(blob)
+
+def read_latest(path: Path = LATEST_FILE) -> Tuple[Optional[bytes], Any]:
+    # one stat() per call; the read + parse only happens when the file actually changed
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None, None
+    return _read_latest_cached(str(path), stat.st_mtime_ns, stat.st_size)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _flatten_cached(ts_utc: str, snapshot_blob: bytes) -> pd.DataFrame:
+    # keyed on the stored snapshot timestamp + raw file bytes, so reruns over an unchanged file skip re-flattening
+    # files written before canonicalize() existed may still carry aliased keys
+    return option_chain_json_to_df(canonicalize(orjson.loads(snapshot_blob)))
+
+
+# Binary history: one Arrow RecordBatch (the flattened chain) per snapshot, appended to an IPC stream
+ARROW_HISTORY_SCHEMA = pa.schema(
+    [("snapshot_ts", pa.string())] + list(CHAIN_SCHEMA) + [("straddle_price", pa.float64()), ("pcr", pa.float64())]
+)
+
+def _close_arrow_history_writer(resource: Tuple[Any, threading.Lock, Any]) -> None:
+    writer, lock, sink = resource
+    with lock:
+        if not sink.closed:
+            writer.close()  # writes the end-of-stream marker
+            sink.close()
+
+@st.cache_resource(show_spinner=False, on_release=_close_arrow_history_writer)
+def _arrow_history_writer(path: Path):
+    # one stream writer per path; each writer appends its own stream to the file. Closed (stream terminated)
+    # when the cache entry is released, e.g. on code reload, and at interpreter exit.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    sink = pa.OSFile(str(path), "ab")
+    resource = (pa.ipc.new_stream(sink, ARROW_HISTORY_SCHEMA), threading.Lock(), sink)
+    atexit.register(_close_arrow_history_writer, resource)
+    return resource
+
+def append_arrow(path: Path, snapshot_ts: str, df: pd.DataFrame) -> None:
+    table = pa.Table.from_pandas(
+        df.assign(snapshot_ts=snapshot_ts), schema=ARROW_HISTORY_SCHEMA, preserve_index=False
+    )
+    writer, lock, _ = _arrow_history_writer(path)
+    with lock:
+        writer.write_table(table)
+
+def read_history_arrow(path: Path = HISTORY_ARROW) -> pa.Table:
+    # The file is a sequence of IPC streams (one per writer). A stream may be cut short (truncated tail) or lack
+    # its end-of-stream marker (process died) with the next stream appended straight after it. So find every
+    # stream by its schema message, read batches one at a time and keep whatever was readable before an error.
+    raw = path.read_bytes()
+    blob = pa.py_buffer(raw)
+    marker = ARROW_HISTORY_SCHEMA.serialize().to_pybytes()
+    batches = []
+    start = raw.find(marker)
+    while start != -1:
+        try:
+            reader = pa.ipc.open_stream(blob.slice(start))
+            while True:
+                batches.append(reader.read_next_batch())
+        except (StopIteration, OSError, pa.ArrowInvalid):
+            pass  # end of stream, truncated tail, or the next stream begins here
+        start = raw.find(marker, start + len(marker))
+    return pa.Table.from_batches(batches, schema=ARROW_HISTORY_SCHEMA)
 
 
 # --------------------------
@@ -191,25 +577,46 @@ st.sidebar.markdown("## Settings")
 instrument_key = st.sidebar.text_input("Instrument Key", value=DEFAULT_INSTRUMENT_KEY)
 poll_seconds = st.sidebar.number_input("Poll interval (seconds)", min_value=2, max_value=600, value=10, step=1)
 auto_find_expiry = st.sidebar.checkbox("Auto-find nearest expiry (recommended)", value=True)
-history_file_show = st.sidebar.text_input("History JSONL file", value=str(HISTORY_FILE))
+write_jsonl = st.sidebar.checkbox("Also write raw JSONL history (debug)", value=False)
+history_file_show = st.sidebar.text_input("History JSONL file (zstd)", value=str(HISTORY_FILE))
 
 # Start/Stop control
 if "live" not in st.session_state:
     st.session_state.live = False
-start_stop = st.sidebar.button("Start" if not st.session_state.live else "Stop")
-if start_stop:
+# set while stopped; the live loop waits on it between polls. on_click callbacks only run at the start of the
+# next script run, so a Stop click is picked up by Streamlit at the first st.* call after the current wait
+# (within one poll interval), not by this event.
+if "stop_event" not in st.session_state:
+    st.session_state.stop_event = threading.Event()
+    st.session_state.stop_event.set()
+stop_event: threading.Event = st.session_state.stop_event
+
+def toggle_live() -> None:
     st.session_state.live = not st.session_state.live
+    if st.session_state.live:
+        st.session_state.stop_event.clear()
+    else:
+        st.session_state.stop_event.set()
+
+st.sidebar.button("Start" if not st.session_state.live else "Stop", on_click=toggle_live)
 
 # small logging area in sidebar
 if "logs" not in st.session_state:
     st.session_state.logs = []
 
-def log(msg: str) -> None:
-    ts = time.strftime("%Y-%m-%d %H:%M:%S")
+def log(msg: str, now: Optional[float] = None) -> None:
+    ts = local_ts(time.time() if now is None else now)
     st.session_state.logs.insert(0, f"[{ts}] {msg}")
 
 # Display token and basic checks
-session = requests.Session()
+# keep the HTTP client (and its open connection) alive across Streamlit reruns
+if "http" not in st.session_state:
+    st.session_state["http_encoding"] = {}
+    st.session_state["http"] = make_http_client(st.session_state["http_encoding"])
+if "_pool" not in st.session_state:
+    st.session_state["_pool"] = ThreadPoolExecutor(max_workers=2)
+client: httpx.Client = st.session_state["http"]
+pool: ThreadPoolExecutor = st.session_state["_pool"]
 token = load_token()
 if token:
     st.sidebar.success("Loaded access token")
@@ -221,11 +628,18 @@ status_placeholder = st.empty()
 table_placeholder = st.empty()
 download_col, info_col = st.columns([1, 2])
 
+def log_encoding_once() -> None:
+    # confirm once per session whether the server honours Accept-Encoding
+    enc = st.session_state.get("http_encoding", {}).get("content-encoding")
+    if enc and not st.session_state.get("http_encoding_logged"):
+        st.session_state["http_encoding_logged"] = True
+        log(f"Upstox response Content-Encoding: {enc}")
+
 # Pre-fetch expiry if requested
 expiry: Optional[str] = None
 if token:
     try:
-        contracts_json = get_contracts(session, token, instrument_key=instrument_key)
+        contracts_json = get_contracts_cached(client, token, instrument_key=instrument_key)
         if auto_find_expiry:
             expiry = choose_nearest_expiry(contracts_json)
         else:
@@ -236,6 +650,8 @@ if token:
     except Exception as e:
         st.sidebar.error(f"Contract API error: {e}")
 
+log_encoding_once()
+
 if expiry:
     st.sidebar.info(f"Using expiry: {expiry}")
 else:
@@ -247,26 +663,41 @@ if expiry_input:
     expiry = expiry_input
 
 # Helper to render latest snapshot -> table
-def render_snapshot_table(snapshot_json):
+def render_snapshot_table(snapshot_json, df: Optional[pd.DataFrame] = None, ts_utc: Optional[str] = None):
     if not snapshot_json or not isinstance(snapshot_json, dict):
         table_placeholder.warning("No snapshot JSON available to convert.")
         return None
-    df = option_chain_json_to_df(snapshot_json.get("data") and snapshot_json or snapshot_json.get("snapshot", snapshot_json))
+    if df is None:
+        df = option_chain_json_to_df(snapshot_json.get("data") and snapshot_json or snapshot_json.get("snapshot", snapshot_json))
     if df.empty:
         table_placeholder.warning("Flattened DataFrame is empty (API returned no strikes).")
         return df
     with table_placeholder.container():
         st.subheader(f"Latest option chain snapshot — expiry {expiry or 'unknown'}")
-        st.text(f"Snapshot timestamp (UTC): {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}")
+        st.text(f"Snapshot timestamp (UTC): {ts_utc or utc_iso(time.time())}")
         st.dataframe(df, use_container_width=True, height=600)
     return df
 
+# Latest snapshot on disk, read once per rerun and shared by the table and the CSV footer
+latest_written = False
+latest_error: Optional[Exception] = None
+try:
+    latest_blob, latest = read_latest()
+except Exception as e:
+    latest_blob, latest, latest_error = None, None, e
+
 # If not live, show latest file if present
 if not st.session_state.live:
     try:
-        if LATEST_FILE.exists():
-            latest = json.loads(LATEST_FILE.read_text())
-            render_snapshot_table(latest.get("snapshot") if isinstance(latest, dict) else latest)
+        if latest_blob is not None:
+            latest_ts = latest.get("timestamp_utc", "") if isinstance(latest, dict) else ""
+            render_snapshot_table(
+                latest.get("snapshot") if isinstance(latest, dict) else latest,
+                df=_flatten_cached(latest_ts, latest_blob),
+                ts_utc=latest_ts or None,
+            )
+        elif latest_error is not None:
+            table_placeholder.error(f"Error reading latest file: {latest_error}")
         else:
             table_placeholder.info("No latest snapshot file found yet. Click 'Fetch one snapshot now' to create one.")
 
@@ -278,13 +709,20 @@ if not st.session_state.live:
             else:
                 try:
                     status_placeholder.info("Fetching option chain...")
-                    sn = fetch_option_chain(session, token, expiry, instrument_key=instrument_key)
+                    sn = fetch_option_chain(client, token, expiry, instrument_key=instrument_key)
+                    now = time.time()
+                    ts_utc = utc_iso(now)
+                    df_sn = option_chain_json_to_df(sn)
                     # save snapshot
-                    append_jsonl(Path(history_file_show), {"timestamp_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "snapshot": sn})
-                    atomic_write_json(LATEST_FILE, {"timestamp_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "snapshot": sn}, indent=2)
+                    record = {"timestamp_utc": ts_utc, "snapshot": sn}
+                    append_arrow(HISTORY_ARROW, ts_utc, df_sn)
+                    if write_jsonl:
+                        append_jsonl(Path(history_file_show), record)
+                    atomic_write_json(LATEST_FILE, record, indent=2)
+                    latest_written = True
                     status_placeholder.success("Saved snapshot to history & latest file.")
-                    log("One-off fetch saved")
-                    render_snapshot_table(sn)
+                    log("One-off fetch saved", now)
+                    render_snapshot_table(sn, df=df_sn, ts_utc=ts_utc)
                 except Exception as e:
                     status_placeholder.error(f"Fetch error: {e}")
     except Exception as e:
@@ -296,58 +734,81 @@ if st.session_state.live:
         status_placeholder.info(f"Live mode ON — polling every {poll_seconds} seconds")
         # single long-running loop - note: this will block the script and Streamlit's UI until stopped
         while st.session_state.live:
+            # one clock read per iteration, reused for the files, status line and log
             start_ts = time.time()
+            ts_utc = utc_iso(start_ts)
             try:
                 if not token:
                     status_placeholder.error("No token loaded — stopping live.")
                     st.session_state.live = False
+                    stop_event.set()
                     break
+                snapshot = None
                 if not expiry:
                     status_placeholder.warning("No expiry selected — attempting to auto-find again.")
-                    contracts_json = get_contracts(session, token, instrument_key=instrument_key)
+                    # speculatively fetch the chain for the last expiry we polled while contracts load
+                    guess_expiry = st.session_state.get("last_expiry")
+                    try:
+                        contracts_json, snapshot = fetch_contracts_and_chain(pool, client, token, guess_expiry, instrument_key=instrument_key)
+                    except RuntimeError as e:
+                        # error payload from the contract API (e.g. 401): retrying every poll won't fix it
+                        log(f"Contract API error: {e}")
+                        contracts_json, snapshot = {}, None
                     expiry = choose_nearest_expiry(contracts_json)
                     if expiry:
                         st.sidebar.info(f"Auto-found expiry: {expiry}")
                     else:
                         status_placeholder.error("Still no expiry found. Stop & check contract API/token.")
                         st.session_state.live = False
+                        stop_event.set()
                         break
+                    if expiry != guess_expiry:
+                        snapshot = None
 
-                snapshot = fetch_option_chain(session, token, expiry, instrument_key=instrument_key)
+                if snapshot is None:
+                    # fetch + parse + flatten on the worker pool; the script thread just blocks on the result
+                    snapshot, df_snapshot = pool.submit(_poll_once, client, token, expiry, instrument_key).result()
+                else:
+                    df_snapshot = option_chain_json_to_df(snapshot)
+                st.session_state["last_expiry"] = expiry
                 # save to files
-                append_jsonl(Path(history_file_show), {"timestamp_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "snapshot": snapshot})
-                atomic_write_json(LATEST_FILE, {"timestamp_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "snapshot": snapshot}, indent=2)
-                status_placeholder.success(f"Fetched & saved snapshot ({time.strftime('%Y-%m-%d %H:%M:%S')})")
-                log("Live fetch saved")
+                record = {"timestamp_utc": ts_utc, "snapshot": snapshot}
+                append_arrow(HISTORY_ARROW, ts_utc, df_snapshot)
+                if write_jsonl:
+                    append_jsonl(Path(history_file_show), record)
+                atomic_write_json(LATEST_FILE, record, indent=2)
+                latest_written = True
+                status_placeholder.success(f"Fetched & saved snapshot ({local_ts(start_ts)})")
+                log("Live fetch saved", start_ts)
+                log_encoding_once()
                 # render table
-                if "snapshot" in snapshot and isinstance(snapshot["snapshot"], dict):
-                    render_snapshot_table(snapshot["snapshot"])
-                else:
-                    render_snapshot_table(snapshot)
+                render_snapshot_table(snapshot, df=df_snapshot, ts_utc=ts_utc)
             except Exception as e:
                 status_placeholder.error(f"Error during fetch/save: {e}")
                 log(f"Error during fetch/save: {e}")
             # throttle to poll_seconds
             elapsed = time.time() - start_ts
             to_sleep = max(0, poll_seconds - elapsed)
-            # frequently check if the user pressed Stop by sleeping in short chunks
-            slept = 0.0
-            chunk = 0.5
-            while slept < to_sleep and st.session_state.live:
-                time.sleep(min(chunk, to_sleep - slept))
-                slept += min(chunk, to_sleep - slept)
+            # one timed wait instead of chunked sleeps; returns early only if something in this process sets the
+            # event (a Stop click interrupts the script at the next st.* call after it)
+            if stop_event.wait(timeout=to_sleep):
+                break
     except Exception as e:
         st.error(f"Live polling stopped due to error: {e}")
         st.session_state.live = False
+        stop_event.set()
 
 # Footer: show history file path and download latest CSV
 st.markdown("---")
-st.write(f"History file (JSONL): `{history_file_show}`")
+st.write(f"History file (Arrow IPC): `{HISTORY_ARROW}`")
+if write_jsonl:
+    st.write(f"History file (JSONL, zstd frames): `{history_file_show}`")
 # Offer to download latest CSV (if available)
 try:
-    if LATEST_FILE.exists():
-        latest = json.loads(LATEST_FILE.read_text())
-        df_latest = option_chain_json_to_df(latest.get("snapshot") if isinstance(latest, dict) else latest)
+    if latest_written:
+        latest_blob, latest = read_latest()
+    if latest_blob is not None:
+        df_latest = _flatten_cached(latest.get("timestamp_utc", "") if isinstance(latest, dict) else "", latest_blob)
         if not df_latest.empty:
             csv_data = df_latest.to_csv(index=False)
             st.download_button("Download latest as CSV", csv_data, file_name=f"nifty_chain_latest_{expiry or 'unknown'}.csv", mime="text/csv")